@@ -1,7 +1,13 @@
-from dataclasses import dataclass, field
+from collections.abc import Iterable
+from dataclasses import asdict, dataclass, field
+from functools import cached_property, lru_cache
+import os
+import stat
 import yaml
 from pathlib import Path
 import argparse
+import io
+import json
 import logging, coloredlogs
 
 logger = logging.getLogger(__name__)
@@ -9,8 +15,11 @@ coloredlogs.install(
     level="INFO", logger=logger, fmt="%(asctime)s %(levelname)s %(message)s"
 )
 
+# libyaml backed loader is much faster, fall back to the pure python one if pyyaml was built without it
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class ConfigHost:
     name: str
     group_name: str
@@ -23,9 +32,28 @@ SHARED_TAG = "shared"
 CUSTOM_PROPERTY_SECRET = "x-secret"
 SECRET_FILE_SUFFIX = ".secrets"
 
+# Parsed roles are kept there between runs, relative to project root
+DISK_CACHE_RELATIVE_PATH = ".cache/generate_config"
+# Bump this whenever ConfigRole changes, to invalidate existing cache files
+DISK_CACHE_VERSION = 2
+
 PLAYBOOK_AUTODETECT_NAMES = ["playbook.yml", "site.yml", "main.yml", "deploy.yml"]
 
 
+@lru_cache(maxsize=None)
+def _path_kind(path: str) -> str:
+    """Stat a path only once and return what it is: "file", "dir", "other" or "missing"."""
+    try:
+        mode = os.stat(path).st_mode
+    except (FileNotFoundError, NotADirectoryError):
+        return "missing"
+    if stat.S_ISREG(mode):
+        return "file"
+    if stat.S_ISDIR(mode):
+        return "dir"
+    return "other"
+
+
 @dataclass(kw_only=True)
 class HostsParser:
 
@@ -37,8 +65,7 @@ class HostsParser:
         if not self.inventory_file.exists():
             raise ValueError(f"No such inventory file: {self.inventory_file}")
 
-        with self.inventory_file.open() as f:
-            inventory = yaml.safe_load(f)
+        inventory = yaml.load(self.inventory_file.read_bytes(), Loader=Loader)
 
         if not inventory:
             raise ValueError(f"Failed to read inventory at {self.inventory_file}")
@@ -49,16 +76,17 @@ class HostsParser:
             hosts.append(ConfigHost(SHARED_HOST_NAME, "all"))
 
         # then every host appearing in the inventory
-        for top_data in inventory.values():
-            for group, group_data in top_data["children"].items():
-                if "hosts" in group_data:
-                    for host in group_data["hosts"]:
-                        hosts.append(ConfigHost(host, group))
+        hosts.extend(
+            ConfigHost(host, group)
+            for top_data in inventory.values()
+            for group, group_data in top_data["children"].items()
+            for host in group_data.get("hosts") or ()
+        )
 
         return hosts
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ConfigProperty:
     name: str
     type: str | None = None
@@ -68,65 +96,118 @@ class ConfigProperty:
     secret: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class ConfigRole:
     name: str
     description: str = ""
     short_description: str = ""
     properties: list[ConfigProperty] = field(default_factory=list)
+    # Precomputed from properties, to avoid scanning them again for every host
+    has_secrets: bool = field(default=False, init=False)
+    secret_properties: list[ConfigProperty] = field(default_factory=list, init=False)
+    nonsecret_properties: list[ConfigProperty] = field(default_factory=list, init=False)
+
+    def __post_init__(self):
+        for prop in self.properties:
+            if prop.secret:
+                self.secret_properties.append(prop)
+            else:
+                self.nonsecret_properties.append(prop)
+        self.has_secrets = bool(self.secret_properties)
 
 
 @dataclass(kw_only=True)
 class ConfigGenerator:
     project_root: Path
     main_file: Path
+    use_disk_cache: bool = True
+
+    # Roles are shared between many hosts, keep what we already parsed around
+    _role_cache: dict[str, ConfigRole] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _dependant_roles_cache: dict[str, set[str]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _direct_deps_cache: dict[str, list[str]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _accumulated_roles_cache: dict[tuple[str, frozenset[str]], set[str]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _block_cache: dict[tuple[str, bool], str] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _mkdir_cache: set[Path] = field(default_factory=set, init=False, repr=False)
 
     def parse_role(self, role: str) -> ConfigRole:
         """
         Parse meta/argument_specs.yml and defaults/main.yml in a role to build annotated variable documentation.
-        Return a ConfigRole object.
+        Return a ConfigRole object. Results are cached per role.
         """
+        if role in self._role_cache:
+            return self._role_cache[role]
+
+        config_role = self._parse_role(role)
+        self._role_cache[role] = config_role
+        return config_role
+
+    def _parse_role(self, role: str) -> ConfigRole:
         role_path: Path = self.project_root / "roles" / role
         specs_path = role_path / "meta" / "argument_specs.yml"
         defaults_path = role_path / "defaults" / "main.yml"
 
-        if not specs_path.exists():
-            logger.debug(f"Role '{role_path.name}' has no argument_specs.yml")
+        if not self._role_exists(role) or _path_kind(str(specs_path)) == "missing":
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Role '%s' has no argument_specs.yml", role_path.name)
             return ConfigRole(name=role_path.name)
 
-        with specs_path.open() as f:
-            specs = yaml.safe_load(f)
+        cache_key = None
+        if self.use_disk_cache:
+            cache_key = self._disk_cache_key(specs_path, defaults_path)
+            cached_role = self._load_disk_cached_role(role, cache_key)
+            if cached_role is not None:
+                return cached_role
+
+        specs = yaml.load(specs_path.read_bytes(), Loader=Loader)
 
         defaults = {}
-        if defaults_path.exists():
-            with defaults_path.open() as f:
-                defaults = yaml.safe_load(f) or {}
+        if _path_kind(str(defaults_path)) != "missing":
+            defaults = yaml.load(defaults_path.read_bytes(), Loader=Loader) or {}
 
         short_description = ""
         description = ""
         properties: list[ConfigProperty] = []
+        # kept along the role in disk cache, to be shown again on later runs
+        warnings: list[str] = []
 
         arg_specs = specs and specs.get("argument_specs", {}).get("main", {})
         if arg_specs:
             description = arg_specs.get("description", {})
             if not description:
-                logger.warning(
+                warnings.append(
                     f"Role '{role_path.name}' has empty description in argument_specs.yml"
                 )
             short_description = arg_specs.get("short_description", {})
             if not short_description:
-                logger.warning(
+                warnings.append(
                     f"Role '{role_path.name}' has empty short_description in argument_specs.yml"
                 )
+        for warning in warnings:
+            logger.warning(warning)
 
         if options := arg_specs and arg_specs.get("options", {}):
             for var_name, meta in options.items():
-                type = meta.get("type", None)
-                description = meta.get("description", "").strip()
-                required = meta.get("required", False)
-                secret = meta.get(CUSTOM_PROPERTY_SECRET, False)
-
-                default = defaults.get(var_name, meta.get("default"))
+                mget = meta.get
+                type = mget("type")
+                description = mget("description", "").strip()
+                required = mget("required", False)
+                secret = mget(CUSTOM_PROPERTY_SECRET, False)
+
+                # avoid looking up the spec default when the role defaults already have it
+                default = (
+                    defaults[var_name] if var_name in defaults else mget("default")
+                )
 
                 properties.append(
                     ConfigProperty(
@@ -139,22 +220,109 @@ class ConfigGenerator:
                     )
                 )
 
-        return ConfigRole(
+        config_role = ConfigRole(
             name=role_path.name,
             description=description,
             short_description=short_description,
             properties=properties,
         )
+        if cache_key is not None:
+            self._store_disk_cached_role(role, cache_key, config_role, warnings)
+        return config_role
+
+    @property
+    def disk_cache_dir(self) -> Path:
+        return self.project_root / DISK_CACHE_RELATIVE_PATH
+
+    def _disk_cache_file(self, role: str) -> Path:
+        # nested roles (like `group/role`) are flattened into a single file name
+        return self.disk_cache_dir / f"{role.replace('/', '--')}.json"
 
-    def build_role_config(self, config_role: ConfigRole, secrets: bool) -> list[str]:
+    @staticmethod
+    def _disk_cache_key(specs_path: Path, defaults_path: Path) -> list:
+        """Roles files modification times, a role cached with a different key is outdated."""
+        defaults_mtime = None
+        if _path_kind(str(defaults_path)) != "missing":
+            defaults_mtime = defaults_path.stat().st_mtime_ns
+        return [DISK_CACHE_VERSION, specs_path.stat().st_mtime_ns, defaults_mtime]
+
+    def _load_disk_cached_role(self, role: str, cache_key: list) -> ConfigRole | None:
+        """
+        Return the role from the disk cache, or None if not cached, outdated or unreadable.
+        Warnings found when the role was first parsed are logged again.
+        """
+        try:
+            cached = json.loads(self._disk_cache_file(role).read_bytes())
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or cached.get("key") != cache_key:
+            return None
+
+        try:
+            data = cached["role"]
+            config_role = ConfigRole(
+                name=data["name"],
+                description=data["description"],
+                short_description=data["short_description"],
+                properties=[ConfigProperty(**prop) for prop in data["properties"]],
+            )
+            warnings = list(cached["warnings"])
+        except (KeyError, TypeError):
+            # a cache is never worth failing for, just parse the role again
+            return None
+
+        for warning in warnings:
+            logger.warning(warning)
+        return config_role
+
+    def _store_disk_cached_role(
+        self, role: str, cache_key: list, config_role: ConfigRole, warnings: list[str]
+    ):
+        data = {
+            "name": config_role.name,
+            "description": config_role.description,
+            "short_description": config_role.short_description,
+            "properties": [asdict(prop) for prop in config_role.properties],
+        }
+        try:
+            payload = json.dumps({"key": cache_key, "role": data, "warnings": warnings})
+        except (TypeError, ValueError):
+            payload = None
+        # some yaml values (dates, non string keys...) do not survive json, don't cache those roles
+        if payload is None or json.loads(payload)["role"] != data:
+            logger.debug("Role '%s' can't be cached to disk", role)
+            return
+
+        cache_file = self._disk_cache_file(role)
+        try:
+            self.disk_cache_dir.mkdir(parents=True, exist_ok=True)
+            # write aside then move, so that a concurrent run never reads a partial file
+            tmp_file = cache_file.with_name(f".{cache_file.stem}.{os.getpid()}.tmp")
+            tmp_file.write_text(payload, encoding="utf-8")
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logger.warning("Failed to write role '%s' disk cache: %s", role, e)
+
+    def build_role_config(
+        self, role: str, config_role: ConfigRole, secrets: bool, buf: io.StringIO
+    ):
         """
         Parse meta/argument_specs.yml and defaults/main.yml in a role to build annotated variable documentation.
-        Return a list of lines.
+        Write the resulting lines to the provided buffer. Results are cached per role and secrets flag.
 
         Args:
+            role (str): The role as referenced in the playbook, used as cache key (the role name is only its basename).
             config_role (ConfigRole): The role to build config for.
             secrets (bool): Whether to process secret variables (and only those if set)
+            buf (io.StringIO): The buffer to write the lines to, each terminated by a newline.
         """
+        key = (role, secrets)
+        if key not in self._block_cache:
+            block = self._build_role_config(config_role, secrets)
+            self._block_cache[key] = "\n".join(block) + "\n"
+        buf.write(self._block_cache[key])
+
+    def _build_role_config(self, config_role: ConfigRole, secrets: bool) -> list[str]:
         block = [
             f"\n### Role: {config_role.name}{f' - {config_role.short_description}' if config_role.short_description else ''}"
         ]
@@ -163,10 +331,11 @@ class ConfigGenerator:
         block.append("#" * 64)
         block.append("")
         if config_role.properties:
-            for prop in config_role.properties:
-                if prop.secret != secrets:
-                    continue
-
+            for prop in (
+                config_role.secret_properties
+                if secrets
+                else config_role.nonsecret_properties
+            ):
                 block.append(
                     f"#  ({'REQUIRED' if prop.required else 'Optional'}) {prop.description}"
                 )
@@ -183,8 +352,7 @@ class ConfigGenerator:
         else:
             block.append("(no options)")
 
-        has_secrets = any(p.secret for p in config_role.properties)
-        if not secrets and has_secrets:
+        if not secrets and config_role.has_secrets:
             block.append(
                 f"# Note: This role has secret variables. See the corresponding '{SECRET_FILE_SUFFIX}' file for the list of those variables."
             )
@@ -195,28 +363,66 @@ class ConfigGenerator:
     def get_dependant_roles(self, role: str) -> set[str]:
         """
         Returns roles that the provided role depends on.
-        Only supports meta/main.yml deps
+        Only supports meta/main.yml deps. Results are cached per role and should not be modified.
         """
+        if role in self._dependant_roles_cache:
+            return self._dependant_roles_cache[role]
 
-        roles: set[str] = set()
+        roles = self._get_dependant_roles(role)
+        self._dependant_roles_cache[role] = roles
+        return roles
 
-        role_dir = self.project_root / "roles" / role
-        if role_dir.is_dir() is False:
-            logger.warning(f"Failed to find role directory for role '{role}'")
-            return roles
-
-        meta_file: Path = role_dir / "meta/main.yml"
-        if meta_file.is_file():
-            with meta_file.open() as f:
-                meta = yaml.safe_load(f) or {}
-                deps = meta.get("dependencies", [])
-                for dep in deps:
-                    dep_role = dep["role"]
+    def _get_dependant_roles(self, role: str) -> set[str]:
+        # Iterative walk, so that shared or cyclic dependencies are only visited once
+        roles: set[str] = set()
+        stack = [role]
+        while stack:
+            for dep_role in self._direct_deps(stack.pop()):
+                if dep_role not in roles:
                     roles.add(dep_role)
-                    roles.update(self.get_dependant_roles(dep_role))
+                    stack.append(dep_role)
 
         return roles
 
+    def _direct_deps(self, role: str) -> list[str]:
+        """Returns roles the provided role directly depends on, reading its meta/main.yml only once."""
+        if role in self._direct_deps_cache:
+            return self._direct_deps_cache[role]
+
+        deps: list[str] = []
+        role_dir = self.project_root / "roles" / role
+        if not self._role_exists(role):
+            logger.warning("Failed to find role directory for role '%s'", role)
+        else:
+            meta_file: Path = role_dir / "meta/main.yml"
+            if _path_kind(str(meta_file)) == "file":
+                meta = yaml.load(meta_file.read_bytes(), Loader=Loader) or {}
+                deps = [dep["role"] for dep in meta.get("dependencies", [])]
+
+        self._direct_deps_cache[role] = deps
+        return deps
+
+    def _role_exists(self, role: str) -> bool:
+        # index only has top level roles, nested ones (like `group/role`) need a stat
+        return (
+            role in self.roles_index
+            or _path_kind(str(self.project_root / "roles" / role)) == "dir"
+        )
+
+    @cached_property
+    def roles_index(self) -> dict[str, os.DirEntry]:
+        """Roles directories found in the project, scanned only once."""
+        try:
+            with os.scandir(self.project_root / "roles") as entries:
+                return {entry.name: entry for entry in entries if entry.is_dir()}
+        except FileNotFoundError:
+            return {}
+
+    @cached_property
+    def main_parsed(self) -> list:
+        """Main playbook file content, parsed only once."""
+        return yaml.load(self.main_file.read_bytes(), Loader=Loader)
+
     @staticmethod
     def extract_role_names(roles_data):
         """Convert roles data from various formats to a list of role names."""
@@ -242,20 +448,32 @@ class ConfigGenerator:
             )
         return role_names
 
-    def accumulate_roles(self, group_name: str) -> set[str]:
+    def accumulate_roles(
+        self, group_name: str, skip_roles: frozenset[str] = frozenset()
+    ) -> set[str]:
         """Tries to find roles included for a given group in the main playbook file.
         This is very basic and only supports static roles inclusion.
+        Results are cached per group and should not be modified.
 
         Args:
             group_name (str): The group name to find roles for.
+            skip_roles (frozenset[str]): Roles to leave out of the result. Must already contain their own dependencies (such as the shared roles).
 
         Returns:
             set[str]: Roles found to be included or this group.
         """
+        # many hosts usually share the same group
+        key = (group_name, skip_roles)
+        if key not in self._accumulated_roles_cache:
+            self._accumulated_roles_cache[key] = self._accumulate_roles(*key)
+        return self._accumulated_roles_cache[key]
+
+    def _accumulate_roles(
+        self, group_name: str, skip_roles: frozenset[str]
+    ) -> set[str]:
         main_roles: set[str] = set()
 
-        with self.main_file.open() as f:
-            main = yaml.safe_load(f)
+        main = self.main_parsed
 
         # rudtry finding all tasks matching the provided group name.
         for task in main:
@@ -269,77 +487,106 @@ class ConfigGenerator:
 
         # would be nice to support some simple includes as well
 
+        # no need to look at dependencies of skipped roles, they're skipped as well
+        main_roles.difference_update(skip_roles)
+
         # now accumulate dependant roles as well
         accumulated_roles = main_roles.copy()
         for role in main_roles:
             accumulated_roles.update(self.get_dependant_roles(role))
 
+        accumulated_roles.difference_update(skip_roles)
         return accumulated_roles
 
-    def generate_example_config(self, host_name: str, roles: set[str], secrets: bool):
+    def generate_example_config(
+        self, host_name: str, roles: Iterable[str], secrets: bool
+    ):
         """
         Create an example config file for given host
 
         Args:
             host_name (str): The host name to create config for.
-            roles (set[str]): The roles to include configs from.
+            roles (Iterable[str]): The roles to include configs from.
             secrets (bool): Whether to process secret variables (and only those if set)
         """
         output_dir = self.project_root / "host_vars" / host_name
-        output_dir.mkdir(parents=True, exist_ok=True)
+        if output_dir not in self._mkdir_cache:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            self._mkdir_cache.add(output_dir)
         stem = host_name if not secrets else f"{host_name}{SECRET_FILE_SUFFIX}"
         output_file = (
             output_dir / f".{stem}.yml.example"
         )  # leading dot to avoid ansible picking it up
 
-        lines = ["---"]
-        lines.append("# Autogenerated example config from roles argument_specs")
+        buf = io.StringIO()
+        buf.write("---\n")
+        buf.write("# Autogenerated example config from roles argument_specs\n")
         if secrets:
-            lines.append(
-                "# SECRETS: This file contains only secret variables and is meant as a list of variables you should put in a vault or some secret manager, instead of here."
+            buf.write(
+                "# SECRETS: This file contains only secret variables and is meant as a list of variables you should put in a vault or some secret manager, instead of here.\n"
             )
         if host_name == SHARED_HOST_NAME:
-            lines.append(
+            buf.write(
                 "# These are the shared configs applied for all hosts. Any value here can be overriden in the specific host config.\n"
-                "# Use the `shared` tag (in main playbook) to make configs appear here."
+                "# Use the `shared` tag (in main playbook) to make configs appear here.\n"
             )
 
         for role in roles:
             config_role = self.parse_role(role)
             # If we're generating the secret file, don't create empty role config blocks for roles with no variables at all
-            if secrets and not any(p.secret for p in config_role.properties):
+            if secrets and not config_role.has_secrets:
                 continue
 
-            lines.extend(self.build_role_config(config_role, secrets))
+            self.build_role_config(role, config_role, secrets, buf)
 
-        with output_file.open("w") as f:
-            f.write("\n".join(lines) + "\n\n")
+        buf.write("\n")
+        output_file.write_text(buf.getvalue(), encoding="utf-8")
 
-        logger.info(f"Generated example config: {output_file}")
+        logger.info("Generated example config: %s", output_file)
 
     def generate(self, hosts: list[ConfigHost]):
         """
         Create an example config file for given host
         """
 
-        roles_per_host: dict[str, set[str]] = {}
+        # if we have a shared config, process it first so that other hosts can skip any role that is already in shared
+        shared_roles: set[str] = set()
         for host in hosts:
-            roles_per_host[host.name] = self.accumulate_roles(host.group_name)
+            if host.name == SHARED_HOST_NAME:
+                shared_roles = self.accumulate_roles(host.group_name)
 
-        # if we have a shared config, remove from other hosts any role that is already in shared
-        if SHARED_HOST_NAME in roles_per_host:
-            all_roles = roles_per_host[SHARED_HOST_NAME]
-            for name, roles in roles_per_host.items():
-                if name != SHARED_HOST_NAME:
-                    roles.difference_update(all_roles)
+        # built once, it's part of the accumulated roles cache key
+        skip_roles = frozenset(shared_roles)
+        roles_per_host: dict[str, set[str]] = {}
+        for host in hosts:
+            if host.name == SHARED_HOST_NAME:
+                roles_per_host[host.name] = shared_roles
+            else:
+                roles_per_host[host.name] = self.accumulate_roles(
+                    host.group_name, skip_roles=skip_roles
+                )
 
         for name, roles in roles_per_host.items():
-            logger.info(f"Accumulated roles for host {name}: {roles}")
-            self.generate_example_config(host_name=name, roles=roles, secrets=True)
-            self.generate_example_config(host_name=name, roles=roles, secrets=False)
+            logger.info("Accumulated roles for host %s: %s", name, roles)
+            self.generate_host_configs(name, roles)
 
         return 0
 
+    def generate_host_configs(self, host_name: str, roles: set[str]):
+        """
+        Create both the secrets and regular example config files for given host
+
+        Args:
+            host_name (str): The host name to create configs for.
+            roles (set[str]): The roles to include configs from.
+        """
+        self.generate_example_config(host_name=host_name, roles=roles, secrets=False)
+        # Roles are already parsed by the non secrets pass, only keep those with secrets (in the same order)
+        secret_roles = [role for role in roles if self.parse_role(role).has_secrets]
+        self.generate_example_config(
+            host_name=host_name, roles=secret_roles, secrets=True
+        )
+
 
 def find_playbook() -> Path | None:
     """Try finding a playbook file in the current working directory, using standard names"""
@@ -379,6 +626,13 @@ if __name__ == "__main__":
         default=True,
         help=f"Create also the special 'all' shared config file, for main playbook tasks tagged with '{SHARED_TAG}'",
     )
+    parser.add_argument(
+        "--disk-cache",
+        dest="disk_cache",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help=f"Keep parsed roles in '{DISK_CACHE_RELATIVE_PATH}' relative to project main file, to speed up later runs",
+    )
     args = parser.parse_args()
 
     if args.playbook_main_file == AUTODETECT:
@@ -397,6 +651,13 @@ if __name__ == "__main__":
             exit(1)
 
     logger.info(f"Start creating configurations files, using main file {main_file}")
+    if Loader is yaml.SafeLoader:
+        logger.warning(
+            "libyaml not found, falling back to slower pure python yaml parsing. "
+            "Reinstall pyyaml against libyaml headers with `pip install pyyaml --no-binary pyyaml` to speed this up."
+        )
+    else:
+        logger.debug("Using libyaml CSafeLoader for yaml parsing")
 
     project_root = main_file.absolute().parent
 
@@ -404,7 +665,11 @@ if __name__ == "__main__":
         project_root / DEFAULT_INVENTORY_RELATIVE_PATH
     )
     hosts = HostsParser(inventory_file=inventory_file).get_hosts(args.process_shared)
-    gen = ConfigGenerator(project_root=project_root, main_file=main_file)
+    gen = ConfigGenerator(
+        project_root=project_root,
+        main_file=main_file,
+        use_disk_cache=args.disk_cache,
+    )
     gen.generate(hosts)
 
     logger.info("Done")